@@ -8,9 +8,16 @@ Ejecución automática para descargar datos de Kobo y subirlos a Google Sheets.
 import os
 import json
 import re
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import numpy as np
+import xlsxwriter
 from google.oauth2.service_account import Credentials
 import gspread
 
@@ -19,26 +26,94 @@ KOBO_URL = "https://kf.kobotoolbox.org/assets/axWwJY5A9AeyzcJPtjACaf/submissions
 OUTPUT_FOLDER = "output"
 OUTPUT_FILE = os.path.join(OUTPUT_FOLDER, "2_ReporteInfCampo.xlsx")
 CREDENTIALS_FILE = "credentials.json"
+CACHE_FOLDER = "cache"
+CACHE_FILE = os.path.join(CACHE_FOLDER, "submissions.json")
+FULL_REFRESH_DAYS = 7  # cada cuánto se ignora la caché y se descarga todo de Kobo
 SHEET_ID = "1uhpIYhuFhfYJlHuJKq1VDsj9jFPXS4iW2qxdyPL4aiA"  # <-- reemplazar por tu ID real
+DOWNLOAD_WORKERS = 8  # páginas de Kobo descargadas en paralelo
+EMPLOYEE_KEYWORDS = ["TiqueteCajon", "TiqueteCable", "OperariosCosecha"]
 
 
 # ===== UTILIDADES =====
+_INVALID_SHEET_CHARS = str.maketrans({c: "_" for c in "/\\?*[]:"})
+_WHITESPACE = re.compile(r"\s+")
+
+
 def sanitize_sheet_name(name: str, maxlen: int = 31) -> str:
     """Limpia nombres para hojas (quita caracteres inválidos y trunca)."""
     if not isinstance(name, str) or not name:
         name = "sheet"
-    cleaned = re.sub(r"[\/\\\?\*\[\]\:]", "_", name)
-    cleaned = re.sub(r"\s+", "_", cleaned)[:maxlen]
+    cleaned = name.translate(_INVALID_SHEET_CHARS)
+    cleaned = _WHITESPACE.sub("_", cleaned)[:maxlen]
     return cleaned
 
 
+def to_json(value) -> str:
+    """Serializa a JSON con orjson; usa json estándar en los casos que orjson rechaza."""
+    try:
+        return orjson.dumps(value).decode("utf-8")
+    except TypeError:
+        # Claves no texto, enteros > 64 bits o texto no UTF-8
+        return json.dumps(value, ensure_ascii=False)
+
+
+# Resultados de infer_dtype para columnas sin listas/dicts posibles
+_SCALAR_INFERRED_TYPES = {
+    "empty",
+    "string",
+    "bytes",
+    "integer",
+    "floating",
+    "mixed-integer-float",
+    "decimal",
+    "complex",
+    "boolean",
+    "datetime64",
+    "datetime",
+    "date",
+    "timedelta64",
+    "timedelta",
+    "time",
+    "period",
+}
+
+
+def may_contain_nested(values: pd.Series) -> bool:
+    """
+    Indica si la columna puede traer listas/dicts. infer_dtype recorre toda la
+    columna en C: las columnas puras (texto, números...) se descartan y las
+    mixtas ("mixed", "mixed-integer", ...) se revisan luego celda por celda.
+    """
+    if values.dtype != object:
+        return False
+    inferred = pd.api.types.infer_dtype(values, skipna=True)
+    return inferred not in _SCALAR_INFERRED_TYPES
+
+
+def serialize_nested_columns(df: pd.DataFrame, columns=None) -> pd.DataFrame:
+    """
+    Convierte a JSON las celdas lista/dict. Solo se revisan celda por celda
+    las columnas que pueden traerlas (ver may_contain_nested).
+    """
+    if columns is None:
+        columns = df.select_dtypes(include="object").columns
+    for col in columns:
+        values = df[col]
+        if not may_contain_nested(values):
+            continue
+        mask = values.map(lambda x: isinstance(x, (list, dict)))
+        if mask.any():
+            df[col] = values.mask(mask, values[mask].map(to_json))
+    return df
+
+
 def safe_serialize(value):
     """Convierte listas/dicts a JSON string; deja demás tipos tal cual (limpia NaN/inf)."""
     if pd.isna(value):
         return ""
     if isinstance(value, (list, dict)):
         try:
-            return json.dumps(value, ensure_ascii=False)
+            return to_json(value)
         except Exception:
             return str(value)
     if isinstance(value, (np.generic,)):
@@ -46,17 +121,87 @@ def safe_serialize(value):
     return value
 
 
+# ===== SESIÓN HTTP =====
+def create_session() -> requests.Session:
+    """Sesión con pool de conexiones (keep-alive) y reintentos ante errores temporales."""
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": "kobo-sync/1.0"})
+    return session
+
+
+_session = create_session()
+
+
 # ===== DESCARGA (paginada/respuesta lista) =====
-def get_all_submissions(url, headers=None):
+def fetch_json(session, url, headers=None):
+    """Descarga una página y la decodifica con orjson."""
+    print(f"📥 Descargando: {url}")
+    resp = session.get(url, headers=headers or {})
+    resp.raise_for_status()
+    try:
+        return orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        # orjson solo acepta UTF-8; requests detecta otras codificaciones
+        return resp.json()
+
+
+def build_page_urls(next_url: str, count: int):
+    """
+    Arma las URLs de las páginas restantes a partir del enlace `next`
+    (parámetros start/limit). Retorna None si el enlace no usa offsets.
+    """
+    parts = urlsplit(next_url)
+    query = parse_qs(parts.query, keep_blank_values=True)
+    try:
+        start = int(query["start"][0])
+        limit = int(query["limit"][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+    if limit <= 0:
+        return None
+    urls = []
+    for offset in range(start, count, limit):
+        query["start"] = [str(offset)]
+        urls.append(urlunsplit(parts._replace(query=urlencode(query, doseq=True))))
+    return urls
+
+
+def get_all_submissions(url, headers=None, session=None):
     """Descarga todos los resultados de Kobo manejando paginación o lista directa."""
-    all_results = []
-    next_url = url
-    session = requests.Session()
+    session = session or _session
+    data = fetch_json(session, url, headers)
+    if isinstance(data, list):
+        return data
+    if not isinstance(data, dict):
+        print("⚠ Respuesta inesperada de la API - tipo desconocido")
+        return []
+
+    all_results = list(data.get("results", []))
+    next_url = data.get("next")
+    count = data.get("count")
+
+    # Con `count` y offsets en `next`, las páginas restantes se piden en paralelo
+    page_urls = None
+    if next_url and isinstance(count, int):
+        page_urls = build_page_urls(next_url, count)
+    if page_urls:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            pages = executor.map(
+                lambda page_url: fetch_json(session, page_url, headers), page_urls
+            )
+            for page in pages:
+                all_results.extend(page.get("results", []))
+        return all_results
+
     while next_url:
-        print(f"📥 Descargando: {next_url}")
-        resp = session.get(next_url, headers=headers or {})
-        resp.raise_for_status()
-        data = resp.json()
+        data = fetch_json(session, next_url, headers)
         if isinstance(data, dict):
             results = data.get("results", [])
             all_results.extend(results)
@@ -70,97 +215,269 @@ def get_all_submissions(url, headers=None):
     return all_results
 
 
+# ===== CACHÉ LOCAL DE ENVÍOS =====
+def load_cached_submissions(filename: str):
+    """
+    Lee la caché de la ejecución anterior: (envíos, fecha ISO de la última
+    descarga completa). Sin caché, o con un formato anterior, retorna ([], None).
+    """
+    if not os.path.exists(filename):
+        return [], None
+    with open(filename, "rb") as f:
+        data = orjson.loads(f.read())
+    if not isinstance(data, dict):
+        return [], None
+    return data.get("results", []), data.get("full_download_at")
+
+
+def save_cached_submissions(results: list, full_download_at: str, filename: str):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "wb") as f:
+        f.write(orjson.dumps({"full_download_at": full_download_at, "results": results}))
+
+
+def needs_full_refresh(full_download_at) -> bool:
+    """
+    Indica si hay que ignorar la caché y descargar todos los envíos.
+    La descarga incremental solo trae envíos con _submission_time nuevo: no ve
+    ediciones, cambios de estado de validación ni envíos borrados en Kobo, así
+    que el reporte puede estar desactualizado hasta FULL_REFRESH_DAYS días.
+    La variable de entorno KOBO_FULL_REFRESH=1 fuerza la descarga completa.
+    """
+    flag = os.environ.get("KOBO_FULL_REFRESH", "").strip().lower()
+    if flag in ("1", "true", "yes", "si"):
+        return True
+    if not full_download_at:
+        return True
+    try:
+        last = datetime.fromisoformat(full_download_at)
+    except ValueError:
+        return True
+    return datetime.now(timezone.utc) - last >= timedelta(days=FULL_REFRESH_DAYS)
+
+
+def last_submission_time(cached: list):
+    """Último _submission_time de la caché, o None si la caché no sirve para filtrar."""
+    if not cached or any("_id" not in r for r in cached):
+        return None
+    return max((r.get("_submission_time") or "" for r in cached), default="") or None
+
+
+def filter_submissions_since(url: str, since: str) -> str:
+    """Agrega a la URL de Kobo el filtro (estilo MongoDB) por _submission_time."""
+    parts = urlsplit(url)
+    query = parse_qs(parts.query, keep_blank_values=True)
+    # $gte (no $gt) para no perder envíos del mismo segundo; se deduplican por _id
+    query["query"] = [to_json({"_submission_time": {"$gte": since}})]
+    return urlunsplit(parts._replace(query=urlencode(query, doseq=True)))
+
+
+def merge_submissions(cached: list, new_results: list) -> list:
+    """
+    Une caché y descargas nuevas por _id (la versión nueva reemplaza a la guardada).
+    Los envíos borrados en Kobo siguen en la caché hasta la próxima descarga completa.
+    """
+    if not cached:
+        return new_results
+    merged = {r["_id"]: r for r in cached}
+    for r in new_results:
+        merged[r["_id"]] = r
+    return list(merged.values())
+
+
 # ===== SEPARAR CAMPOS ANIDADOS =====
 def split_nested_data(df: pd.DataFrame, parent_name="Main"):
     """
-    Detecta columnas con listas/dict y genera sub-dataframes.
-    Retorna df plano (con columnas anidadas serializadas) y dict de sub_dfs.
+    Detecta columnas con listas/dict y genera sub-dataframes
+    (los dicts anidados se aplanan con pd.json_normalize).
+    Retorna df y dict de sub_dfs; la serialización y limpieza de valores
+    se hace una sola vez después, en clean_for_output.
     """
     sub_dfs = {}
-    for col in list(df.columns):
-        mask = df[col].apply(lambda x: isinstance(x, (list, dict)))
-        if mask.any():
-            rows = []
-            for idx, val in df[col].items():
-                row_series = df.loc[idx]
-                parent_id = row_series.get("_id", idx)
-                if isinstance(val, list):
-                    for i, item in enumerate(val):
-                        if isinstance(item, dict):
-                            row = {"parent_id": parent_id, "item_index": i}
-                            for k, v in item.items():
-                                row[k] = v
-                        else:
-                            row = {
-                                "parent_id": parent_id,
-                                "item_index": i,
-                                "value": item,
-                            }
-                        rows.append(row)
-                elif isinstance(val, dict):
-                    row = {"parent_id": parent_id}
-                    for k, v in val.items():
-                        row[k] = v
-                    rows.append(row)
-            if rows:
-                sub_name = f"{parent_name}_{col}"
-                sub_df = pd.DataFrame(rows)
-                sub_df = sub_df.replace([np.inf, -np.inf], np.nan).fillna("")
-                sub_dfs[sub_name] = sub_df
-            df[col] = df[col].apply(
-                lambda x: json.dumps(x, ensure_ascii=False)
-                if isinstance(x, (list, dict))
-                else ("" if pd.isna(x) else x)
-            )
+    # Columnas mixtas (p. ej. "" y dicts) también pasan al recorrido por filas,
+    # que revisa celda por celda
+    nested_cols = [col for col in df.columns if may_contain_nested(df[col])]
+    if not nested_cols:
+        return df, sub_dfs
+
+    # Un solo recorrido por filas (tuplas) en vez de df.loc[idx] por celda.
+    # Por columna se acumulan los registros hijos y, en listas paralelas,
+    # el parent_id y el item_index de cada uno.
+    col_idx = {c: i for i, c in enumerate(df.columns)}
+    id_pos = col_idx.get("_id")
+    collected = {col: ([], [], []) for col in nested_cols}
+    for idx, row in zip(df.index, df.itertuples(index=False, name=None)):
+        parent_id = row[id_pos] if id_pos is not None else idx
+        for col in nested_cols:
+            val = row[col_idx[col]]
+            records, parent_ids, indices = collected[col]
+            if isinstance(val, list):
+                for i, item in enumerate(val):
+                    if not isinstance(item, dict):
+                        item = {"value": item}
+                    records.append(item)
+                    parent_ids.append(parent_id)
+                    indices.append(i)
+            elif isinstance(val, dict):
+                records.append(val)
+                parent_ids.append(parent_id)
+                indices.append(None)
+
+    for col in nested_cols:
+        records, parent_ids, indices = collected[col]
+        if records:
+            sub_name = f"{parent_name}_{col}"
+            sub_df = pd.json_normalize(records, sep=".")
+            sub_df.insert(0, "parent_id", parent_ids)
+            if any(i is not None for i in indices):
+                sub_df.insert(1, "item_index", indices)
+            sub_dfs[sub_name] = sub_df
     return df, sub_dfs
 
 
 # ===== EXPANDIR EMPLEADOS =====
+def explode_employee_columns(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    """
+    Separa por espacios los textos de cada columna de `columns` y genera una fila
+    por empleado. Los valores que no son texto o no tienen espacios se conservan.
+    Con varias columnas se combinan todas contra todas, como antes; por eso se
+    expanden una tras otra y no con explode(columns), que las empareja por posición.
+    """
+    df = df.reset_index(drop=True)
+    for col in columns:
+        values = df[col].tolist()
+        if not any(isinstance(x, str) and " " in x for x in values):
+            continue
+        # Los textos con espacios se separan y el resto se envuelve en [x],
+        # así explode solo multiplica las celdas separadas (las listas quedan igual)
+        cells = [x.split() if isinstance(x, str) and " " in x else [x] for x in values]
+        # Textos con solo espacios no generan filas (igual que antes)
+        keep = [len(c) > 0 for c in cells]
+        df = df.assign(**{col: pd.Series(cells, index=df.index, dtype=object)})[keep]
+        df = df.explode(col, ignore_index=True)
+    return df
+
+
 def expand_employees_in_subdfs(dfs: dict) -> dict:
     """
     Recorre todas las hojas y expande en nuevas filas
     los campos que contengan TiqueteCajon, TiqueteCable u OperariosCosecha.
     """
-    employee_keywords = ["TiqueteCajon", "TiqueteCable", "OperariosCosecha"]
     new_dfs = {}
 
     for name, df in dfs.items():
-        df_expanded = df.copy()
-        for col in df.columns:
-            if any(key in col for key in employee_keywords):
-                rows = []
-                for _, row in df_expanded.iterrows():
-                    val = row[col]
-                    if isinstance(val, str) and " " in val:
-                        empleados = [
-                            emp.strip() for emp in val.split(" ") if emp.strip()
-                        ]
-                        for emp in empleados:
-                            new_row = row.copy()
-                            new_row[col] = emp
-                            rows.append(new_row)
-                    else:
-                        rows.append(row)
-                df_expanded = pd.DataFrame(rows)
-        new_dfs[name] = df_expanded
+        emp_cols = [
+            col for col in df.columns if any(key in col for key in EMPLOYEE_KEYWORDS)
+        ]
+        new_dfs[name] = explode_employee_columns(df, emp_cols) if emp_cols else df
 
     return new_dfs
 
 
+# ===== LIMPIEZA PARA SALIDAS =====
+def clean_for_output(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Deja los valores listos para Excel y Google Sheets: NaN/inf como "" y
+    listas/dicts como JSON. Solo se tocan las columnas con faltantes; las
+    numéricas completas quedan en numpy.
+    """
+    obj_cols = df.select_dtypes(include="object").columns
+    df = serialize_nested_columns(df.copy(), obj_cols)
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_float_dtype(values.dtype):
+            invalid = ~np.isfinite(values.to_numpy(dtype=float, na_value=np.nan))
+        else:
+            if col in obj_cols:
+                values = values.replace([np.inf, -np.inf], np.nan)
+            invalid = values.isna().to_numpy()
+        if invalid.any():
+            df[col] = values.astype(object).where(~invalid, "")
+    return df
+
+
 # ===== GUARDAR A EXCEL =====
 def save_to_excel(dfs: dict, filename: str):
+    """Escribe las hojas ya limpias (ver clean_for_output) en un archivo Excel."""
     os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with pd.ExcelWriter(filename, engine="openpyxl") as writer:
+    # constant_memory libera cada fila al escribirla; exige escribir fila por fila,
+    # por eso no se usa df.to_excel (que escribe columna por columna).
+    options = {
+        "constant_memory": True,
+        "strings_to_urls": False,
+        "nan_inf_to_errors": True,
+    }
+    with xlsxwriter.Workbook(filename, options) as workbook:
+        header_format = workbook.add_format(
+            {"bold": True, "border": 1, "align": "center", "valign": "top"}
+        )
+        used_names = set()
         for name, df in dfs.items():
             sheet_name = sanitize_sheet_name(name, maxlen=31)
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+            # Nombres largos pueden coincidir al truncar a 31 caracteres
+            suffix = 1
+            while sheet_name.lower() in used_names:
+                suffix += 1
+                tail = f"_{suffix}"
+                sheet_name = sanitize_sheet_name(name, maxlen=31 - len(tail)) + tail
+            used_names.add(sheet_name.lower())
+
+            worksheet = workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0, 0, [str(c) for c in df.columns], header_format)
+            rows = df.itertuples(index=False, name=None)
+            for row_num, row in enumerate(rows, start=1):
+                worksheet.write_row(row_num, 0, row)
     print(
         f"✅ Archivo Excel generado con {dfs.get('Main').shape[0] if 'Main' in dfs else 0} registros en:\n{filename}"
     )
 
 
 # ===== SUBIR A GOOGLE SHEETS (MODO INCREMENTAL) =====
+def read_sheets_values(spreadsheet, titles: list) -> dict:
+    """Lee varias hojas con una sola llamada a values.batchGet (título -> filas)."""
+    if not titles:
+        return {}
+    ranges = ["'{}'".format(title.replace("'", "''")) for title in titles]
+    resp = spreadsheet.values_batch_get(
+        ranges, params={"valueRenderOption": "UNFORMATTED_VALUE"}
+    )
+    value_ranges = resp.get("valueRanges", [])
+    return {
+        title: value_range.get("values", [])
+        for title, value_range in zip(titles, value_ranges)
+    }
+
+
+def values_to_frame(values: list) -> pd.DataFrame:
+    """Arma un DataFrame desde las filas de una hoja (la primera es el encabezado)."""
+    if not values:
+        return pd.DataFrame()
+    header, rows = values[0], values[1:]
+    # La API omite las celdas vacías al final de cada fila
+    width = max(map(len, rows), default=0)
+    if width > len(header):
+        header = header + [f"_col{i}" for i in range(len(header), width)]
+    return pd.DataFrame(rows, columns=header, dtype=object).fillna("")
+
+
+def row_keys(df: pd.DataFrame, columns: list) -> pd.Series:
+    """Clave de texto por fila (columnas unidas con "_"), armada por columnas."""
+    # Se fuerza dtype object: con pandas >= 3 astype(str) da strings de Arrow,
+    # cuyo isin es ~10x más lento que la tabla hash de objetos de pandas.
+    keys = df[columns[0]].astype(str).astype(object)
+    for col in columns[1:]:
+        keys = keys + "_" + df[col].astype(str).astype(object)
+    return keys
+
+
+def filter_new_rows(df: pd.DataFrame, existing_df: pd.DataFrame, columns: list):
+    """Filas de `df` cuya clave no está todavía en la hoja."""
+    existing_keys = row_keys(existing_df, columns)
+    return df[~row_keys(df, columns).isin(existing_keys)]
+
+
 def upload_to_google_sheets(dfs: dict, sheet_id: str, creds_file: str):
+    """Agrega solo los registros nuevos; `dfs` ya viene limpio (ver clean_for_output)."""
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive",
@@ -169,34 +486,27 @@ def upload_to_google_sheets(dfs: dict, sheet_id: str, creds_file: str):
     client = gspread.authorize(creds)
     spreadsheet = client.open_by_key(sheet_id)
 
-    for name, df in dfs.items():
-        df_clean = df.replace([np.inf, -np.inf], np.nan).fillna("")
-        df_clean = df_clean.applymap(
-            lambda x: json.dumps(x, ensure_ascii=False)
-            if isinstance(x, (list, dict))
-            else x
-        )
-        sheet_name = sanitize_sheet_name(name, maxlen=100)
+    # Contenido de todas las hojas existentes en una sola petición
+    worksheets = {ws.title: ws for ws in spreadsheet.worksheets()}
+    sheet_names = {name: sanitize_sheet_name(name, maxlen=100) for name in dfs}
+    existing_values = read_sheets_values(
+        spreadsheet,
+        [title for title in dict.fromkeys(sheet_names.values()) if title in worksheets],
+    )
 
-        try:
-            worksheet = spreadsheet.worksheet(sheet_name)
-            existing_data = worksheet.get_all_records()
-            existing_df = pd.DataFrame(existing_data)
+    for name, df_clean in dfs.items():
+        sheet_name = sheet_names[name]
+
+        if sheet_name in worksheets:
+            worksheet = worksheets[sheet_name]
+            existing_df = values_to_frame(existing_values.get(sheet_name, []))
 
             # === Validación de registros nuevos ===
             if name == "Main":
                 if "_id" in df_clean.columns and "_id" in existing_df.columns:
-                    new_df = df_clean[
-                        ~df_clean["_id"].astype(str).isin(
-                            existing_df["_id"].astype(str)
-                        )
-                    ]
+                    new_df = filter_new_rows(df_clean, existing_df, ["_id"])
                 elif "submission_id" in df_clean.columns and "submission_id" in existing_df.columns:
-                    new_df = df_clean[
-                        ~df_clean["submission_id"].astype(str).isin(
-                            existing_df["submission_id"].astype(str)
-                        )
-                    ]
+                    new_df = filter_new_rows(df_clean, existing_df, ["submission_id"])
                 else:
                     new_df = df_clean
             else:
@@ -205,31 +515,20 @@ def upload_to_google_sheets(dfs: dict, sheet_id: str, creds_file: str):
                         "item_index" in df_clean.columns
                         and "item_index" in existing_df.columns
                     ):
-                        merged = (
-                            existing_df[["parent_id", "item_index"]]
-                            .astype(str)
-                            .agg("_".join, axis=1)
-                        )
-                        current = (
-                            df_clean[["parent_id", "item_index"]]
-                            .astype(str)
-                            .agg("_".join, axis=1)
+                        new_df = filter_new_rows(
+                            df_clean, existing_df, ["parent_id", "item_index"]
                         )
-                        new_df = df_clean[~current.isin(merged)]
                     else:
-                        new_df = df_clean[
-                            ~df_clean["parent_id"]
-                            .astype(str)
-                            .isin(existing_df["parent_id"].astype(str))
-                        ]
+                        new_df = filter_new_rows(df_clean, existing_df, ["parent_id"])
                 else:
                     new_df = df_clean
-        except gspread.exceptions.WorksheetNotFound:
+        else:
             worksheet = spreadsheet.add_worksheet(
                 title=sheet_name,
                 rows=max(1, df_clean.shape[0] + 1),
                 cols=max(1, df_clean.shape[1]),
             )
+            worksheets[sheet_name] = worksheet
             worksheet.update([df_clean.columns.values.tolist()])
             new_df = df_clean
 
@@ -244,11 +543,24 @@ def upload_to_google_sheets(dfs: dict, sheet_id: str, creds_file: str):
 
 # ===== FLUJO PRINCIPAL =====
 def main():
-    results = get_all_submissions(KOBO_URL)
+    cached, full_download_at = load_cached_submissions(CACHE_FILE)
+    since = None
+    if not needs_full_refresh(full_download_at):
+        since = last_submission_time(cached)
+    if since:
+        print(f"🗂 {len(cached)} envíos en caché; descargando desde {since}")
+        url = filter_submissions_since(KOBO_URL, since)
+    else:
+        cached = []
+        url = KOBO_URL
+        full_download_at = datetime.now(timezone.utc).isoformat()
+    results = merge_submissions(cached, get_all_submissions(url, session=_session))
     if not results:
         print("⚠ No se encontraron registros en Kobo.")
         return
 
+    save_cached_submissions(results, full_download_at, CACHE_FILE)
+
     df_main = pd.DataFrame(results)
 
     if "_id" in df_main.columns:
@@ -264,6 +576,9 @@ def main():
     # Expandir empleados en sub-hojas (post-proceso)
     dfs = expand_employees_in_subdfs(dfs)
 
+    # Una sola pasada de limpieza/serialización para Excel y Google Sheets
+    dfs = {name: clean_for_output(df) for name, df in dfs.items()}
+
     save_to_excel(dfs, OUTPUT_FILE)
     upload_to_google_sheets(dfs, SHEET_ID, CREDENTIALS_FILE)
 